@@ -0,0 +1,364 @@
+"""
+End to end CPU benchmark of train.py.
+
+Runs `train()` with a tiny random Llama model, a locally built tokenizer and a synthetic chat dataset,
+without network, GPU or wandb. Every scenario runs in its own process and records startup, preprocessing,
+training throughput, peak RSS and checkpoint write time. The report is compared against
+benchmarks/baseline.json and the exit code is non zero on a regression.
+
+    python benchmark.py                              # run all scenarios and compare with the baseline
+    python benchmark.py --scenarios lora-16,full-32  # run a subset
+    python benchmark.py --update_baseline            # record the current numbers as the new baseline
+"""
+import time
+
+PROCESS_START = time.perf_counter()
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import platform
+import resource
+import functools
+import tempfile
+import subprocess
+from os.path import join, dirname, abspath
+
+REPO_DIR = dirname(abspath(__file__))
+DEFAULT_BASELINE = join(REPO_DIR, 'benchmarks', 'baseline.json')
+
+SCENARIOS = {
+    'lora-16': ['--bits', '16', '--bf16'],
+    'lora-32': ['--bits', '32'],
+    'full-32': ['--full_finetune', '--bits', '32'],
+}
+
+COMMON_ARGS = [
+    '--report_to', 'none',
+    '--optim', 'adamw_torch',
+    '--use_cpu',
+    '--model_max_len', '256',
+    '--num_train_epochs', '1',
+    '--per_device_train_batch_size', '4',
+    '--per_device_eval_batch_size', '4',
+    '--gradient_accumulation_steps', '2',
+    '--logging_steps', '10',
+    '--save_strategy', 'steps',
+    '--save_steps', '20',
+    '--save_total_limit', '1',
+    '--do_train',
+    '--do_eval',
+    '--eval_dataset_size', '0.1',
+    '--lora_r', '8',
+    '--seed', '42',
+]
+
+# Metrics where larger numbers are better, every other metric is a duration or a size.
+HIGHER_IS_BETTER = {'steps_per_second', 'tokens_per_second'}
+# Timings are only comparable with a baseline recorded under the same values.
+COMPARABLE_ENVIRONMENT = ('cpu_count', 'num_threads', 'torch', 'transformers')
+
+NUM_CONVERSATIONS = 1024
+NUM_WORDS = 1000
+
+
+def _sentence(rng, words, num_words):
+    return ' '.join(rng.choice(words) for _ in range(num_words))
+
+
+def make_fixture(fixture_dir, seed=0):
+    """
+    Writes a synthetic chat dataset, a word level tokenizer and a tiny random Llama model to `fixture_dir`.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+    import torch
+
+    rng = random.Random(seed)
+    words = [f'w{idx}' for idx in range(NUM_WORDS)]
+
+    os.makedirs(join(fixture_dir, 'data'), exist_ok=True)
+    with open(join(fixture_dir, 'data', 'train.jsonl'), 'w') as outfile:
+        for idx in range(NUM_CONVERSATIONS):
+            conversation = []
+            if idx % 3 == 0:
+                conversation.append({'role': 'system', 'content': _sentence(rng, words, 8)})
+            for _ in range(rng.randint(1, 3)):
+                conversation.append({'role': 'user', 'content': _sentence(rng, words, rng.randint(5, 40))})
+                conversation.append({'role': 'assistant', 'content': _sentence(rng, words, rng.randint(5, 60))})
+            outfile.write(json.dumps({'conversation': conversation}) + '\n')
+
+    # The directory name must not contain `llama`, train.py would force the slow llama tokenizer otherwise.
+    model_dir = join(fixture_dir, 'tiny-random')
+    tokenizer = Tokenizer(models.WordLevel(unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.train_from_iterator(
+        [' '.join(words), '[INST] [/INST] <<SYS>> <</SYS>> A B C D'],
+        trainers.WordLevelTrainer(special_tokens=['<unk>', '<s>', '</s>'])
+    )
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token='<s>', eos_token='</s>', unk_token='<unk>')
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=256,
+        intermediate_size=512,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        max_position_embeddings=512,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    LlamaForCausalLM(config).save_pretrained(model_dir, safe_serialization=True)
+    return model_dir, join(fixture_dir, 'data')
+
+
+def run_scenario(name, fixture_dir, output_dir, metrics_path):
+    """
+    Runs train.train() in this process for one scenario and writes its metrics to `metrics_path`.
+    """
+    sys.path.insert(0, REPO_DIR)
+    import peft
+    import transformers
+    import train
+
+    timings = {}
+    depth = {}
+    results = {}
+
+    def timed(key, fn):
+        # Only the outermost call is counted, so nested save methods are not added up twice.
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            depth[key] = depth.get(key, 0) + 1
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                depth[key] -= 1
+                if depth[key] == 0:
+                    timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+        return wrapper
+
+    get_accelerate_model = timed('model_load_seconds', train.get_accelerate_model)
+    def get_accelerate_model_and_mark(*args, **kwargs):
+        result = get_accelerate_model(*args, **kwargs)
+        results['startup_seconds'] = time.perf_counter() - PROCESS_START
+        return result
+    train.get_accelerate_model = get_accelerate_model_and_mark
+
+    make_data_module = timed('preprocess_seconds', train.make_data_module)
+    def make_data_module_and_count(*args, **kwargs):
+        data_module = make_data_module(*args, **kwargs)
+        results['train_tokens'] = sum(len(ids) for ids in data_module['train_dataset'][train.DS_FULL_KEY])
+        return data_module
+    train.make_data_module = make_data_module_and_count
+
+    trainer_train = transformers.Trainer.train
+    def trainer_train_and_record(self, *args, **kwargs):
+        # Evals and checkpoints inside the training loop have their own metrics, leave them out of the throughput.
+        excluded = lambda: timings.get('eval_seconds', 0.0) + timings.get('checkpoint_seconds', 0.0)
+        start, excluded_before = time.perf_counter(), excluded()
+        output = trainer_train(self, *args, **kwargs)
+        results['train_seconds'] = time.perf_counter() - start - (excluded() - excluded_before)
+        results['train_metrics'] = output.metrics
+        results['train_steps'] = output.global_step
+        return output
+    transformers.Trainer.train = trainer_train_and_record
+    transformers.Trainer.evaluate = timed('eval_seconds', transformers.Trainer.evaluate)
+
+    transformers.Trainer._save_checkpoint = timed('checkpoint_seconds', transformers.Trainer._save_checkpoint)
+    train.SavePeftModelCallback.save_model = timed('checkpoint_seconds', train.SavePeftModelCallback.save_model)
+    transformers.PreTrainedModel.save_pretrained = timed('checkpoint_seconds', transformers.PreTrainedModel.save_pretrained)
+    peft.PeftModel.save_pretrained = timed('checkpoint_seconds', peft.PeftModel.save_pretrained)
+
+    sys.argv = [
+        'train.py',
+        '--model_name_or_path', join(fixture_dir, 'tiny-random'),
+        '--dataset', join(fixture_dir, 'data'),
+        '--output_dir', output_dir,
+        '--final_output_dir', join(output_dir, 'final'),
+        *COMMON_ARGS,
+        *SCENARIOS[name],
+    ]
+    train.train()
+
+    train_metrics = results['train_metrics']
+    metrics = {
+        'startup_seconds': results['startup_seconds'],
+        'model_load_seconds': timings['model_load_seconds'],
+        'preprocess_seconds': timings['preprocess_seconds'],
+        'steps_per_second': results['train_steps'] / results['train_seconds'],
+        'tokens_per_second': results['train_tokens'] * train_metrics['epoch'] / results['train_seconds'],
+        'eval_seconds': timings.get('eval_seconds', 0.0),
+        'checkpoint_seconds': timings.get('checkpoint_seconds', 0.0),
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    with open(metrics_path, 'w') as outfile:
+        json.dump(metrics, outfile, indent=2)
+
+
+def get_environment(num_threads):
+    import torch
+    import transformers
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'num_threads': num_threads,
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+    }
+
+
+def environment_mismatches(environment, baseline):
+    recorded = baseline.get('environment', {})
+    return [
+        f'{key} is {environment[key]} here but {recorded.get(key)} in the baseline'
+        for key in COMPARABLE_ENVIRONMENT if environment[key] != recorded.get(key)
+    ]
+
+
+def compare(scenarios, baseline):
+    """
+    Returns a description of every metric that is worse than the baseline by more than its tolerance.
+    A tolerance has a `relative` part and an `absolute` slack, the latter keeps sub-second timings from flapping.
+    """
+    regressions = []
+    tolerances = baseline.get('tolerances', {})
+    for name, metrics in scenarios.items():
+        expected = baseline.get('scenarios', {}).get(name)
+        if not expected:
+            print(f'No baseline recorded for {name}, run with --update_baseline to add one.')
+            continue
+        for key, value in metrics.items():
+            if expected.get(key) is None or key not in tolerances:
+                continue
+            relative, absolute = tolerances[key].get('relative', 0.0), tolerances[key].get('absolute', 0.0)
+            if key in HIGHER_IS_BETTER:
+                limit = expected[key] * (1 - relative) - absolute
+                regressed = value < limit
+            else:
+                limit = expected[key] * (1 + relative) + absolute
+                regressed = value > limit
+            if regressed:
+                regressions.append(f'{name}: {key} {value:.4g} vs baseline {expected[key]:.4g} (limit {limit:.4g})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end CPU benchmark of train.py.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenarios to run.')
+    parser.add_argument('--report', default='benchmark_report.json', help='Where to write the json report.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline to compare against.')
+    parser.add_argument('--update_baseline', action='store_true', help='Store the measured numbers as the baseline.')
+    parser.add_argument('--num_threads', type=int, default=min(4, os.cpu_count() or 1),
+                        help='Torch CPU threads, fixed for comparable numbers. Must not exceed the number of CPUs.')
+    parser.add_argument('--ignore_environment', action='store_true',
+                        help='Compare even if CPUs, threads or library versions differ from the baseline.')
+    parser.add_argument('--keep_workdir', action='store_true', help='Do not delete fixtures, outputs and logs.')
+    # Used by the parent process to run a single scenario in a fresh interpreter.
+    parser.add_argument('--run_scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        scenario_dir = join(args.workdir, args.run_scenario)
+        run_scenario(args.run_scenario, join(args.workdir, 'fixture'), join(scenario_dir, 'output'), join(scenario_dir, 'metrics.json'))
+        return
+
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'Unknown scenarios {unknown}, choose from {list(SCENARIOS)}.')
+
+    if args.num_threads > (os.cpu_count() or 1):
+        parser.error(f'--num_threads {args.num_threads} exceeds the {os.cpu_count()} available CPUs, '
+                     f'oversubscribed timings are too noisy to compare.')
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)
+    environment = get_environment(args.num_threads)
+    if not args.update_baseline and not baseline.get('scenarios'):
+        sys.exit(f'{args.baseline} has no recorded numbers yet. Record them on the reference machine with '
+                 f'--update_baseline first.')
+    mismatches = [] if args.update_baseline else environment_mismatches(environment, baseline)
+    for mismatch in mismatches:
+        print(f'ENVIRONMENT MISMATCH {mismatch}')
+    if mismatches and not args.ignore_environment:
+        sys.exit('Refusing to compare against a baseline recorded in a different environment. Record one for this '
+                 'machine with --update_baseline, or pass --ignore_environment to compare anyway.')
+
+    workdir = tempfile.mkdtemp(prefix='qlora-bench-')
+    print(f'Building fixtures in {workdir}...')
+    make_fixture(join(workdir, 'fixture'))
+
+    env = dict(
+        os.environ,
+        CUDA_VISIBLE_DEVICES='',
+        WANDB_DISABLED='true',
+        WANDB_MODE='disabled',
+        HF_HUB_OFFLINE='1',
+        HF_DATASETS_OFFLINE='1',
+        TRANSFORMERS_OFFLINE='1',
+        OMP_NUM_THREADS=str(args.num_threads),
+        MKL_NUM_THREADS=str(args.num_threads),
+    )
+    scenarios = {}
+    try:
+        for name in names:
+            scenario_dir = join(workdir, name)
+            os.makedirs(scenario_dir)
+            # A datasets cache per scenario, so preprocessing is measured without earlier runs' cache files.
+            env['HF_DATASETS_CACHE'] = join(scenario_dir, 'datasets-cache')
+            print(f'Running {name}...')
+            with open(join(scenario_dir, 'log.txt'), 'w') as log:
+                completed = subprocess.run(
+                    [sys.executable, abspath(__file__), '--run_scenario', name, '--workdir', workdir],
+                    cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+                )
+            if completed.returncode != 0:
+                args.keep_workdir = True
+                raise RuntimeError(f'Scenario {name} failed, see {join(scenario_dir, "log.txt")}')
+            with open(join(scenario_dir, 'metrics.json')) as infile:
+                scenarios[name] = json.load(infile)
+            print(json.dumps(scenarios[name], indent=2))
+    finally:
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'environment': environment,
+        'environment_mismatches': mismatches,
+        'scenarios': scenarios,
+        'regressions': compare(scenarios, baseline),
+    }
+    with open(args.report, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f'Wrote {args.report}')
+
+    if args.update_baseline:
+        if baseline.get('scenarios') and environment_mismatches(environment, baseline):
+            # Numbers of scenarios that were not rerun here were measured elsewhere, they must not carry this environment.
+            print(f'Environment differs from {args.baseline}, dropping its other scenarios.')
+            baseline['scenarios'] = {}
+        baseline['environment'] = report['environment']
+        baseline.setdefault('scenarios', {}).update(scenarios)
+        with open(args.baseline, 'w') as outfile:
+            json.dump(baseline, outfile, indent=2)
+            outfile.write('\n')
+        print(f'Updated {args.baseline}')
+        return
+
+    for regression in report['regressions']:
+        print(f'REGRESSION {regression}')
+    if report['regressions']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,11 +14,20 @@ def install_flash_attn():
 
 
 import json
+import contextlib
+import math
 import shutil
+import zlib
+import functools
+import itertools
+import hashlib
+import sqlite3
 from os.path import exists, join, isdir
+import dataclasses
 from dataclasses import dataclass, field
 from typing import Optional, Dict, Sequence, Any, List
 import numpy as np
+import pyarrow.compute as pc
 from datasets.formatting.formatting import LazyBatch
 from tqdm import tqdm
 import logging
@@ -48,6 +57,7 @@ from peft import (
 )
 from peft.tuners.lora import LoraLayer
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.integrations import is_deepspeed_zero3_enabled
 from accelerate import Accelerator
 from huggingface_hub import ModelCard
 
@@ -85,6 +95,9 @@ DEFAULT_PAD_TOKEN = "[PAD]"
 CONVERSATION_KEY = 'conversation'
 DS_FULL_KEY='full'
 DS_PROMPT_LEN_KEY='prompt_lens'
+MINHASH_NUM_PERM = 128
+MINHASH_SHINGLE_SIZE = 5
+MINHASH_PRIME = (1 << 61) - 1
 
 @dataclass
 class ModelArguments:
@@ -135,6 +148,38 @@ class DataArguments:
         default="ALL",
         metadata={"help": "Comma separated list of sources to include (source field in dataset)"}
     )
+    tokenization_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of a per-conversation tokenization cache. Unchanged rows reuse their token ids, "
+                          "so only new or edited rows are tokenized when a dataset grows."}
+    )
+    dedup: bool = field(
+        default=False,
+        metadata={"help": "Drop conversations that repeat the normalized content of an earlier one."}
+    )
+    dedup_near_threshold: Optional[float] = field(
+        default=None,
+        metadata={"help": "Also drop near duplicates, i.e. conversations whose estimated Jaccard similarity (MinHash "
+                          "over word 5-grams, candidates found with LSH) to a kept one is at least this value, e.g. 0.8."}
+    )
+    dedup_num_proc: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of processes used to hash conversations for dedup."}
+    )
+    dry_run_data: bool = field(
+        default=False,
+        metadata={"help": "Only build the training data on CPU, then report its length distribution, padding waste "
+                          "and projected optimizer steps to stdout and `output_dir/data_report.json`. No model is loaded."}
+    )
+    dry_run_world_size: Optional[int] = field(
+        default=None,
+        metadata={"help": "World size used for the dry run step projection. Defaults to WORLD_SIZE or 1."}
+    )
+    dry_run_tokens_per_second: Optional[float] = field(
+        default=None,
+        metadata={"help": "Expected training throughput of the whole job in tokens/sec, padding included. If set, "
+                          "the dry run also projects the time per epoch."}
+    )
 
 @dataclass
 class TrainingArguments(transformers.Seq2SeqTrainingArguments):
@@ -165,6 +210,11 @@ class TrainingArguments(transformers.Seq2SeqTrainingArguments):
         default=2048,
         metadata={"help": "Maximum source sequence length for mmlu."}
     )
+    mmlu_prefix_caching: bool = field(
+        default=False,
+        metadata={"help": "Run the few-shot prefix shared by the questions of a subject once and reuse its KV cache for "
+                          "every question. Not supported with DeepSpeed ZeRO-3 or FSDP."}
+    )
     full_finetune: bool = field(
         default=False,
         metadata={"help": "Finetune the entire model without adapters."}
@@ -197,6 +247,16 @@ class TrainingArguments(transformers.Seq2SeqTrainingArguments):
         default=0.0,
         metadata={"help":"Lora dropout."}
     )
+    multi_adapter_config: Optional[str] = field(
+        default=None,
+        metadata={"help": "Path to a json list of LoRA adapters trained together on the same base model and batches. "
+                          "Each entry needs a `name` and may override `lora_r`, `lora_alpha`, `lora_dropout` and `learning_rate`."}
+    )
+    low_ram_loading: bool = field(
+        default=False,
+        metadata={"help": "16/32-bit only. Build the model on the meta device and load memory mapped safetensors shards "
+                          "directly in the target dtype onto each rank's device, instead of a full CPU copy per rank."}
+    )
     max_memory_MB: int = field(
         default=80000,
         metadata={"help": "Free memory per gpu."}
@@ -282,6 +342,59 @@ def find_all_linear_names(args, model):
         lora_module_names.remove('lm_head')
     return list(lora_module_names)
 
+def load_adapter_configs(args):
+    """
+    Returns the LoRA adapters to train, one dict per adapter. Without `multi_adapter_config` this is
+    the single `default` adapter described by the lora arguments.
+    """
+    defaults = dict(
+        lora_r=args.lora_r,
+        lora_alpha=args.lora_alpha,
+        lora_dropout=args.lora_dropout,
+        learning_rate=args.learning_rate,
+    )
+    if args.multi_adapter_config is None:
+        return [dict(name='default', **defaults)]
+
+    if args.full_finetune or args.deepspeed or args.using_fsdp or int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        raise ValueError("multi_adapter_config is only supported for single process (Q)LoRA training.")
+    with open(args.multi_adapter_config) as infile:
+        entries = json.load(infile)
+    adapter_configs = []
+    for entry in entries:
+        unknown_keys = set(entry) - set(defaults) - {'name'}
+        if 'name' not in entry or unknown_keys:
+            raise ValueError(f"Invalid adapter entry {entry}, expected a `name` and optionally {sorted(defaults)}.")
+        name = entry['name']
+        if not isinstance(name, str) or not name or '.' in name:
+            # Adapter names become module and parameter path segments, e.g. `lora_A.<name>.weight`.
+            raise ValueError(f"Invalid adapter name {name!r}, names must be non empty strings without '.'.")
+        adapter_configs.append({**defaults, **entry})
+    names = [adapter['name'] for adapter in adapter_configs]
+    if not names or len(set(names)) != len(names):
+        raise ValueError(f"multi_adapter_config must list adapters with unique names, got {names}.")
+    return adapter_configs
+
+def get_adapter_dir(adapter_model_dir, adapter_name):
+    # PeftModel#save_pretrained writes every adapter except `default` into a sub directory named after it.
+    return adapter_model_dir if adapter_name == 'default' else join(adapter_model_dir, adapter_name)
+
+def get_trainable_state_dict(accelerator, model):
+    """
+    Collects only the trainable (adapter) parameters of a DeepSpeed wrapped model, as CPU tensors on the main
+    process and None elsewhere. ZeRO-3 partitioned parameters are gathered first, which all ranks must join.
+    """
+    params = {name: param for name, param in accelerator.unwrap_model(model).named_parameters() if param.requires_grad}
+    gathered = contextlib.nullcontext()
+    if any(hasattr(param, 'ds_id') for param in params.values()):
+        import deepspeed
+        gathered = deepspeed.zero.GatheredParameters(list(params.values()), modifier_rank=None)
+    state_dict = None
+    with gathered:
+        if accelerator.is_main_process:
+            state_dict = {name: param.detach().to('cpu', copy=True) for name, param in params.items()}
+    return state_dict
+
 
 class SavePeftModelCallback(transformers.TrainerCallback):
     def __init__(self, trainer, **_):
@@ -295,12 +408,13 @@ class SavePeftModelCallback(transformers.TrainerCallback):
 
         if getattr(self.trainer, "deepspeed"):
             self.trainer.accelerator.wait_for_everyone()
-            state_dict = self.trainer.accelerator.get_state_dict(self.trainer.deepspeed)
+            state_dict = get_trainable_state_dict(self.trainer.accelerator, self.trainer.deepspeed)
             unwrapped_model = self.trainer.accelerator.unwrap_model(self.trainer.deepspeed)
             if self.trainer.accelerator.is_main_process:
                 unwrapped_model.save_pretrained(peft_model_path, state_dict=state_dict, safe_serialization=True)
             self.trainer.accelerator.wait_for_everyone()
         else:
+            # With several adapters each one lands in its own `adapter_model/<name>` directory.
             kwargs["model"].save_pretrained(peft_model_path, safe_serialization=True)
 
         pytorch_model_path = os.path.join(checkpoint_folder, "pytorch_model.bin")
@@ -324,17 +438,182 @@ class SavePeftModelCallback(transformers.TrainerCallback):
         self.save_model(args, state, kwargs)
         touch(join(args.output_dir, 'completed'))
 
-def get_accelerate_model(args, checkpoint_dir):
 
-    if torch.cuda.is_available():
-        n_gpus = torch.cuda.device_count()
-    if is_ipex_available() and torch.xpu.is_available():
-        n_gpus = torch.xpu.device_count()
+def _is_adapter_parameter(param_name, adapter_name):
+    # LoRA weights are named `...lora_A.<adapter>.weight` or `...lora_embedding_A.<adapter>`. Matching the segment
+    # after `lora_*` keeps names such as `0` or `mlp` from also matching `layers.0.` or `.mlp.` in the module path.
+    parts = param_name.split('.')
+    return any(part.startswith('lora_') and following == adapter_name for part, following in zip(parts, parts[1:]))
+
+class MultiAdapterOptimizer(torch.optim.Optimizer):
+    """
+    Steps one optimizer per LoRA adapter. Gradients are clipped per adapter so that adapters trained
+    side by side do not influence each other's updates.
+    """
+    def __init__(self, optimizers: Dict[str, torch.optim.Optimizer], max_grad_norm: float = 0.0):
+        self.optimizers = optimizers
+        self.max_grad_norm = max_grad_norm
+        # Share the param groups of the wrapped optimizers, so learning rate updates are visible here as well.
+        super().__init__([group for optimizer in optimizers.values() for group in optimizer.param_groups], {})
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        for optimizer in self.optimizers.values():
+            if self.max_grad_norm:
+                params = [p for group in optimizer.param_groups for p in group['params']]
+                torch.nn.utils.clip_grad_norm_(params, self.max_grad_norm)
+            optimizer.step()
+
+    def zero_grad(self, set_to_none: bool = True):
+        for optimizer in self.optimizers.values():
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def state_dict(self):
+        return {name: optimizer.state_dict() for name, optimizer in self.optimizers.items()}
+
+    def load_state_dict(self, state_dict):
+        for name, optimizer in self.optimizers.items():
+            optimizer.load_state_dict(state_dict[name])
+
+
+class MultiAdapterScheduler(object):
+    """
+    Steps one learning rate scheduler per adapter optimizer of a MultiAdapterOptimizer.
+    """
+    def __init__(self, optimizer: MultiAdapterOptimizer, schedulers: Dict[str, Any]):
+        self.optimizer = optimizer
+        self.schedulers = schedulers
+
+    def step(self):
+        for scheduler in self.schedulers.values():
+            scheduler.step()
+
+    def get_last_lr(self):
+        return [lr for scheduler in self.schedulers.values() for lr in scheduler.get_last_lr()]
+
+    def state_dict(self):
+        return {name: scheduler.state_dict() for name, scheduler in self.schedulers.items()}
+
+    def load_state_dict(self, state_dict):
+        for name, scheduler in self.schedulers.items():
+            scheduler.load_state_dict(state_dict[name])
 
-    if args.full_finetune:
-        assert args.bits in [16, 32]
 
-    # Tokenizer...
+class PeftTrainer(Seq2SeqTrainer):
+    """
+    Under DeepSpeed, writes only the trainable adapter weights on save, instead of consolidating the whole
+    model for every checkpoint and leaving `save_pretrained` to throw the frozen base away.
+    """
+    def _saves_trainable_only(self):
+        return self.deepspeed is not None and isinstance(self.accelerator.unwrap_model(self.model), PeftModel)
+
+    def save_model(self, output_dir: Optional[str] = None, _internal_call: bool = False):
+        if not self._saves_trainable_only():
+            return super().save_model(output_dir, _internal_call=_internal_call)
+        output_dir = self.args.output_dir if output_dir is None else output_dir
+        state_dict = get_trainable_state_dict(self.accelerator, self.deepspeed)
+        if self.args.should_save:
+            self._save(output_dir, state_dict=state_dict)
+        if self.args.push_to_hub and not _internal_call:
+            self.push_to_hub(commit_message="Model save")
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        if self._saves_trainable_only():
+            # The engine checkpoint holds the optimizer states for resuming; keep the frozen base out of it too.
+            engine = self.model_wrapped
+            engine.save_checkpoint = functools.partial(type(engine).save_checkpoint, engine, exclude_frozen_parameters=True)
+        super()._save_checkpoint(model, trial, metrics=metrics)
+
+
+class MultiAdapterTrainer(Seq2SeqTrainer):
+    """
+    Trains several LoRA adapters of one PeftModel on the same batches. Each batch is run once per adapter
+    with only that adapter active, and every adapter has its own optimizer, scheduler and learning rate.
+    """
+    def __init__(self, model=None, args=None, adapter_configs=None, **kwargs):
+        # Clipping is done per adapter by MultiAdapterOptimizer, a global norm would couple the adapters. The global
+        # clip is turned off on a copy, the caller's arguments keep their max_grad_norm.
+        super().__init__(model=model, args=dataclasses.replace(args, max_grad_norm=0.0), **kwargs)
+        self.adapter_configs = adapter_configs
+        self.adapter_max_grad_norm = args.max_grad_norm
+        self._adapter_losses = {adapter['name']: 0.0 for adapter in adapter_configs}
+        self._adapter_loss_steps = 0
+
+    def create_optimizer(self):
+        if self.optimizer is None:
+            optimizer_cls, optimizer_kwargs = Seq2SeqTrainer.get_optimizer_cls_and_kwargs(self.args)
+            optimizers = {}
+            for adapter in self.adapter_configs:
+                params = [p for n, p in self.model.named_parameters() if _is_adapter_parameter(n, adapter['name'])]
+                optimizers[adapter['name']] = optimizer_cls(
+                    [{'params': params, 'weight_decay': self.args.weight_decay}],
+                    **{**optimizer_kwargs, 'lr': adapter['learning_rate']}
+                )
+            self.optimizer = MultiAdapterOptimizer(optimizers, max_grad_norm=self.adapter_max_grad_norm)
+        return self.optimizer
+
+    def create_scheduler(self, num_training_steps: int, optimizer=None):
+        if self.lr_scheduler is None:
+            optimizer = self.optimizer if optimizer is None else optimizer
+            optimizer = getattr(optimizer, 'optimizer', optimizer) # unwrap AcceleratedOptimizer
+            schedulers = {
+                name: transformers.get_scheduler(
+                    self.args.lr_scheduler_type,
+                    optimizer=adapter_optimizer,
+                    num_warmup_steps=self.args.get_warmup_steps(num_training_steps),
+                    num_training_steps=num_training_steps,
+                )
+                for name, adapter_optimizer in optimizer.optimizers.items()
+            }
+            self.lr_scheduler = MultiAdapterScheduler(optimizer, schedulers)
+        return self.lr_scheduler
+
+    def training_step(self, model, inputs):
+        model.train()
+        inputs = self._prepare_inputs(inputs)
+        peft_model = self.accelerator.unwrap_model(model)
+        total_loss = 0.0
+        for adapter in self.adapter_configs:
+            peft_model.set_adapter(adapter['name'])
+            with self.compute_loss_context_manager():
+                loss = self.compute_loss(model, inputs)
+            if self.args.n_gpu > 1:
+                loss = loss.mean()
+            self.accelerator.backward(loss)
+            loss = loss.detach() / self.args.gradient_accumulation_steps
+            self._adapter_losses[adapter['name']] += loss
+            total_loss += loss
+        self._adapter_loss_steps += 1
+        return total_loss / len(self.adapter_configs)
+
+    def log(self, logs: Dict[str, float]) -> None:
+        if 'loss' in logs and self._adapter_loss_steps > 0:
+            optimizer_steps = self._adapter_loss_steps / self.args.gradient_accumulation_steps
+            learning_rates = self.lr_scheduler.get_last_lr()
+            for adapter, learning_rate in zip(self.adapter_configs, learning_rates):
+                name = adapter['name']
+                logs[f'loss_{name}'] = round(float(self._adapter_losses[name]) / optimizer_steps, 4)
+                logs[f'learning_rate_{name}'] = learning_rate
+                self._adapter_losses[name] = 0.0
+            self._adapter_loss_steps = 0
+        super().log(logs)
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval", **gen_kwargs):
+        peft_model = self.accelerator.unwrap_model(self.model)
+        active_adapter = peft_model.active_adapter
+        metrics = {}
+        for adapter in self.adapter_configs:
+            peft_model.set_adapter(adapter['name'])
+            metrics.update(super().evaluate(
+                eval_dataset,
+                ignore_keys=ignore_keys,
+                metric_key_prefix=f"{metric_key_prefix}_{adapter['name']}",
+                **gen_kwargs
+            ))
+        peft_model.set_adapter(active_adapter)
+        return metrics
+
+def get_tokenizer(args):
     extra_tokens = {}
     for key in ("pad_token", "eos_token", "bos_token", "unk_token"):
         value = getattr(args, key, None)
@@ -352,6 +631,20 @@ def get_accelerate_model(args, checkpoint_dir):
     if not tokenizer.pad_token_id:
         tokenizer.pad_token_id = tokenizer.unk_token_id
         tokenizer.pad_token = tokenizer.unk_token
+    load_template(tokenizer)
+    return tokenizer
+
+def get_accelerate_model(args, checkpoint_dir):
+
+    if torch.cuda.is_available():
+        n_gpus = torch.cuda.device_count()
+    if is_ipex_available() and torch.xpu.is_available():
+        n_gpus = torch.xpu.device_count()
+
+    if args.full_finetune:
+        assert args.bits in [16, 32]
+
+    tokenizer = get_tokenizer(args)
 
     # Ensure the model has the correct token IDs (qwen!!!)
     extra_model_args = {}
@@ -363,8 +656,6 @@ def get_accelerate_model(args, checkpoint_dir):
         extra_model_args["bf16"] = True
         extra_model_args["use_flash_attn"] = True
 
-    load_template(tokenizer)
-
     # Model...
     print(f'loading base model {args.model_name_or_path}...')
     compute_dtype = (torch.float16 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32))
@@ -379,6 +670,15 @@ def get_accelerate_model(args, checkpoint_dir):
             bnb_4bit_use_double_quant=args.double_quant,
             bnb_4bit_quant_type=args.quant_type,
         )
+    low_ram_loading = args.low_ram_loading and bnb_config is None and not is_deepspeed_zero3_enabled()
+    if low_ram_loading:
+        # Parameters are created on the meta device and filled from memory mapped safetensors shards in the
+        # target dtype. Loading straight onto this rank's GPU keeps host memory down to the page cache,
+        # which all local ranks share.
+        extra_model_args["low_cpu_mem_usage"] = True
+        extra_model_args["use_safetensors"] = True
+        if torch.cuda.is_available() and not args.using_fsdp:
+            extra_model_args["device_map"] = {"": int(os.environ.get("LOCAL_RANK", 0))}
     model = AutoModelForCausalLM.from_pretrained(
         args.model_name_or_path,
         cache_dir=args.cache_dir,
@@ -408,7 +708,8 @@ def get_accelerate_model(args, checkpoint_dir):
 
     # Resize token embeddings, if necessary, to accomodate fast tokenizer with added tokens.
     if "qwen" not in args.model_name_or_path:
-        num_new_tokens = len(tokenizer) - len(model.get_input_embeddings().weight.data)
+        # num_embeddings, as under ZeRO-3 the weight only holds this rank's partition.
+        num_new_tokens = len(tokenizer) - model.get_input_embeddings().num_embeddings
         if num_new_tokens > 0:
             input_embeddings_data = model.get_input_embeddings().weight.data
             output_embeddings_data = model.get_output_embeddings().weight.data
@@ -426,34 +727,46 @@ def get_accelerate_model(args, checkpoint_dir):
     if args.gradient_checkpointing and hasattr(model, 'gradient_checkpointing_enable'):
         model.gradient_checkpointing_enable()
 
-    for name, module in model.named_modules():
-        if isinstance(module, LoraLayer):
-            if args.bf16:
-                module = module.to(torch.bfloat16)
-        if 'norm' in name:
-            module = module.to(torch.bfloat16 if args.bf16 else torch.float32)
-        if 'lm_head' in name or 'embed_tokens' in name:
-            if hasattr(module, 'weight'):
-                if args.bf16 and module.weight.dtype == torch.float32:
+    # With low_ram_loading the weights were loaded in their final dtype already, no need for another pass.
+    if not low_ram_loading:
+        for name, module in model.named_modules():
+            if isinstance(module, LoraLayer):
+                if args.bf16:
                     module = module.to(torch.bfloat16)
-    
+            if 'norm' in name:
+                module = module.to(torch.bfloat16 if args.bf16 else torch.float32)
+            if 'lm_head' in name or 'embed_tokens' in name:
+                if hasattr(module, 'weight'):
+                    if args.bf16 and module.weight.dtype == torch.float32:
+                        module = module.to(torch.bfloat16)
+
     if not args.full_finetune:
         if checkpoint_dir is not None:
             print("Loading adapters from checkpoint.")
-            model = PeftModel.from_pretrained(model, join(checkpoint_dir, 'adapter_model'), is_trainable=True)
+            for adapter in args.adapter_configs:
+                adapter_dir = get_adapter_dir(join(checkpoint_dir, 'adapter_model'), adapter['name'])
+                if isinstance(model, PeftModel):
+                    model.load_adapter(adapter_dir, adapter_name=adapter['name'], is_trainable=True)
+                else:
+                    model = PeftModel.from_pretrained(model, adapter_dir, adapter_name=adapter['name'], is_trainable=True)
         else:
             print(f'adding LoRA modules...')
             modules = find_all_linear_names(args, model)
-            config = LoraConfig(
-                r=args.lora_r,
-                lora_alpha=args.lora_alpha,
-                target_modules=modules,
-                lora_dropout=args.lora_dropout,
-                bias="none",
-                task_type="CAUSAL_LM",
-            )
             model.enable_input_require_grads()
-            model = get_peft_model(model, config)
+            for adapter in args.adapter_configs:
+                config = LoraConfig(
+                    r=adapter['lora_r'],
+                    lora_alpha=adapter['lora_alpha'],
+                    target_modules=modules,
+                    lora_dropout=adapter['lora_dropout'],
+                    bias="none",
+                    task_type="CAUSAL_LM",
+                )
+                if isinstance(model, PeftModel):
+                    model.add_adapter(adapter['name'], config)
+                else:
+                    model = get_peft_model(model, config, adapter_name=adapter['name'])
+        model.set_adapter(args.adapter_configs[0]['name'])
     if args.using_fsdp:
         accelerator = Accelerator()
         model = accelerator.prepare_model(model)
@@ -527,11 +840,21 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
     """
     # Load dataset.
     dataset = load_dataset(args.dataset)
+    if args.dedup or args.dedup_near_threshold is not None:
+        for split in dataset:
+            dataset[split] = dedup_conversations(dataset[split], args)
     is_bos_present = _is_bos_present_in_template(tokenizer, dataset['train'][0][CONVERSATION_KEY])
-    map_lamb = lambda x: _apply_and_tokenize_batches(tokenizer, args.model_max_len, x, add_special=not is_bos_present, train_on_source=args.train_on_source)
+    cache = None
+    if args.tokenization_cache_dir is not None:
+        fingerprint = _tokenizer_fingerprint(tokenizer, args.model_max_len, not is_bos_present, args.train_on_source)
+        cache = TokenizationCache(args.tokenization_cache_dir, fingerprint)
+    map_lamb = lambda x: _apply_and_tokenize_batches(tokenizer, args.model_max_len, x, add_special=not is_bos_present, train_on_source=args.train_on_source, cache=cache)
     dataset = dataset.map(map_lamb, batched=True, desc="Apply and Tokenize")
+    if cache is not None and cache.hits + cache.misses > 0:
+        print(f'Tokenization cache: reused {cache.hits} rows, tokenized {cache.misses} rows.')
 
     # Split train/eval, reduce size
+    data_stats = {}
     if args.do_eval or args.do_predict:
         if 'eval' in dataset:
             eval_dataset = dataset['eval']
@@ -560,25 +883,17 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
         if args.group_by_length: # not supported. Let it fail for the time being...
             train_dataset = train_dataset.map(lambda x: {'length': len(x['input']) + len(x['output'])})
 
-    # Remove any training data that exceeds the max length.
-    if args.skip_excess_length:
-        bos = tokenizer.bos_token if not is_bos_present else ''
-        eos = tokenizer.eos_token if not is_bos_present else ''
-
-        def _get_data_length(item):
-            prompt = f"{bos}{item[DS_FULL_KEY]}{eos}"
-            return len(
-                tokenizer(
-                    prompt,
-                    max_length=args.model_max_len + 1,
-                    truncation=True,
-                    add_special_tokens=False
-                ).input_ids
-            )
+        # `full` is truncated to model_max_len while tokenizing, so truncated rows have exactly the maximum length.
+        lengths = _column_lengths(train_dataset, DS_FULL_KEY)
+        data_stats['loaded_rows'] = len(train_dataset)
+        data_stats['truncated_rows'] = int((lengths >= args.model_max_len).sum())
+        data_stats['skipped_excess_length_rows'] = 0
 
-        train_dataset = train_dataset.filter(
-            lambda x: _get_data_length(x) < args.model_max_len - 10
-        )
+        # Remove any training data that exceeds the max length.
+        if args.skip_excess_length:
+            keep = np.flatnonzero(lengths < args.model_max_len - 10)
+            data_stats['skipped_excess_length_rows'] = len(train_dataset) - len(keep)
+            train_dataset = train_dataset.select(keep)
 
     if args.do_train:
         train_dataset = train_dataset.remove_columns(
@@ -599,24 +914,236 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
         train_dataset=train_dataset if args.do_train else None,
         eval_dataset=eval_dataset if args.do_eval else None,
         predict_dataset=eval_dataset if args.do_predict else None,
-        data_collator=data_collator
+        data_collator=data_collator,
+        data_stats=data_stats,
     )
 
+def _normalize_conversation(conversation):
+    return '\x1e'.join(f"{message['role']}\x1f{' '.join(message['content'].lower().split())}" for message in conversation)
+
+@functools.lru_cache(maxsize=None)
+def _minhash_permutations(num_perm):
+    rng = np.random.RandomState(1)
+    a = rng.randint(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    return a, b
+
+def _minhash(text, num_perm):
+    words = text.split()
+    shingles = {' '.join(words[pos:pos + MINHASH_SHINGLE_SIZE]) for pos in range(max(1, len(words) - MINHASH_SHINGLE_SIZE + 1))}
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+    a, b = _minhash_permutations(num_perm)
+    # Universal hashing, the uint64 products are allowed to wrap around.
+    permuted = ((hashes[:, None] * a[None, :] + b[None, :]) % np.uint64(MINHASH_PRIME)) & np.uint64(0xFFFFFFFF)
+    return permuted.min(axis=0).astype(np.uint32)
+
+def _hash_conversations_batch(items, near):
+    normalized = [_normalize_conversation(conversation) for conversation in items[CONVERSATION_KEY]]
+    columns = {
+        'dedup_hash': [hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest() for text in normalized],
+        # Whitespace separated words, a cheap stand-in for tokens that needs no rendering or tokenizer.
+        'dedup_words': [sum(len(message['content'].split()) for message in conversation) for conversation in items[CONVERSATION_KEY]],
+    }
+    if near:
+        columns['dedup_minhash'] = [_minhash(text, MINHASH_NUM_PERM) for text in normalized]
+    return columns
+
+@functools.lru_cache(maxsize=None)
+def _lsh_bands(threshold, num_perm, false_positive_weight=0.1):
+    # (bands, rows) with bands * rows <= num_perm minimizing the weighted area of the LSH S-curve below the threshold
+    # (candidates that are not duplicates) and above it (missed duplicates). Candidates are verified against their
+    # signatures afterwards, so a missed duplicate costs more than a spurious candidate.
+    below, above = np.linspace(0, threshold, 201), np.linspace(threshold, 1, 201)
+
+    def error(bands_rows):
+        bands, rows = bands_rows
+        false_positives = np.mean(1 - (1 - below ** rows) ** bands) * threshold
+        false_negatives = np.mean((1 - above ** rows) ** bands) * (1 - threshold)
+        return false_positive_weight * false_positives + (1 - false_positive_weight) * false_negatives
+
+    candidates = [(bands, rows) for bands in range(1, num_perm + 1) for rows in range(1, num_perm // bands + 1)]
+    return min(candidates, key=error)
+
+def dedup_conversations(dataset, args):
+    """
+    Removes conversations whose normalized content (case and whitespace insensitive) was seen before and,
+    with `dedup_near_threshold`, near duplicates found by MinHash/LSH over word shingles. Hashing runs in
+    `dedup_num_proc` processes, the keep/drop pass then streams over the hashes. First occurrences are kept.
+    """
+    near = args.dedup_near_threshold is not None
+    hashed = dataset.map(
+        _hash_conversations_batch,
+        batched=True,
+        fn_kwargs={'near': near},
+        num_proc=args.dedup_num_proc,
+        remove_columns=dataset.column_names,
+        desc="Hash conversations",
+    )
+    if near:
+        bands, rows = _lsh_bands(args.dedup_near_threshold, MINHASH_NUM_PERM)
+        # Band key -> positions in kept_signatures, per band.
+        buckets = [{} for _ in range(bands)]
+        kept_signatures = []
+
+    seen = set()
+    keep, exact_duplicates, near_duplicates = [], [], []
+    removed_words = 0
+    idx = 0
+    for batch in hashed.iter(batch_size=10000):
+        for pos, content_hash in enumerate(batch['dedup_hash']):
+            if content_hash in seen:
+                exact_duplicates.append(idx)
+                removed_words += batch['dedup_words'][pos]
+            elif near:
+                signature = np.asarray(batch['dedup_minhash'][pos], dtype=np.uint32)
+                keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(bands)]
+                candidates = {kept for key, bucket in zip(keys, buckets) for kept in bucket.get(key, ())}
+                # A band collision only makes a candidate, the share of equal MinHash slots estimates the Jaccard.
+                if candidates and np.max(np.mean(np.stack([kept_signatures[kept] for kept in candidates]) == signature, axis=1)) >= args.dedup_near_threshold:
+                    near_duplicates.append(idx)
+                    removed_words += batch['dedup_words'][pos]
+                else:
+                    for key, bucket in zip(keys, buckets):
+                        bucket.setdefault(key, []).append(len(kept_signatures))
+                    kept_signatures.append(signature)
+                    seen.add(content_hash)
+                    keep.append(idx)
+            else:
+                seen.add(content_hash)
+                keep.append(idx)
+            idx += 1
+
+    removed = exact_duplicates + near_duplicates
+    print(f'Dedup removed {len(removed)} of {len(dataset)} rows ({len(exact_duplicates)} exact, '
+          f'{len(near_duplicates)} near duplicates), {removed_words} words.')
+    return dataset.select(keep) if removed else dataset
+
+def _column_lengths(dataset, column):
+    # Reads list lengths from arrow, without materializing token ids as python lists.
+    return pc.list_value_length(dataset.with_format('arrow')[column]).to_numpy()
+
+def _padded_tokens(lengths, batch_size):
+    # Fixed size batches with a short last one, like the DataLoader.
+    return int(sum(
+        len(lengths[i:i + batch_size]) * lengths[i:i + batch_size].max() for i in range(0, len(lengths), batch_size)
+    ))
+
+def _length_grouped_tokens(lengths, batch_size, megabatch_mult=50):
+    # Same grouping as transformers' LengthGroupedSampler: sort shuffled megabatches, then split them into batches.
+    megabatch_size = megabatch_mult * batch_size
+    return sum(
+        _padded_tokens(np.sort(lengths[i:i + megabatch_size])[::-1], batch_size)
+        for i in range(0, len(lengths), megabatch_size)
+    )
+
+def report_data_statistics(data_module, args):
+    """
+    Prints the length distribution, padding waste and projected optimizer steps of the training data,
+    and writes them to `output_dir/data_report.json`.
+    """
+    train_dataset = data_module['train_dataset']
+    if train_dataset is None or len(train_dataset) == 0:
+        raise ValueError('--dry_run_data needs --do_train and a non empty train split.')
+    lengths = _column_lengths(train_dataset, DS_FULL_KEY)
+    tokens = int(lengths.sum())
+
+    counts, edges = np.histogram(lengths, bins=16, range=(0, args.model_max_len))
+    shuffled = np.random.default_rng(args.seed).permutation(lengths)
+    batch_size = args.per_device_train_batch_size
+    layouts = {
+        'plain': _padded_tokens(shuffled, batch_size),
+        'length_grouped': _length_grouped_tokens(shuffled, batch_size),
+        'packed': math.ceil(tokens / args.model_max_len) * args.model_max_len,
+    }
+
+    world_size = args.dry_run_world_size or int(os.environ.get('WORLD_SIZE', 1))
+    batches_per_epoch = math.ceil(len(lengths) / (batch_size * world_size))
+    steps_per_epoch = max(batches_per_epoch // args.gradient_accumulation_steps, 1)
+
+    report = {
+        **data_module['data_stats'],
+        'train_rows': len(lengths),
+        'tokens': tokens,
+        'length_percentiles': {f'p{p}': int(np.percentile(lengths, p)) for p in (50, 90, 99, 100)},
+        'length_histogram': [
+            {'from': int(lo), 'to': int(hi), 'rows': int(count)} for lo, hi, count in zip(edges, edges[1:], counts)
+        ],
+        'padding': {
+            layout: {'tokens': padded, 'waste': 1 - tokens / padded} for layout, padded in layouts.items()
+        },
+        'world_size': world_size,
+        'steps_per_epoch': steps_per_epoch,
+        'total_steps': math.ceil(steps_per_epoch * args.num_train_epochs),
+    }
+    # With --train_on_source prompt lengths are not computed, so there is no prompt/response split.
+    if DS_PROMPT_LEN_KEY in train_dataset.column_names:
+        prompt_lens = train_dataset.with_format('arrow')[DS_PROMPT_LEN_KEY].to_numpy()
+        report['prompt_tokens'] = int(np.minimum(prompt_lens, lengths).sum())
+        report['response_tokens'] = tokens - report['prompt_tokens']
+    if args.dry_run_tokens_per_second:
+        padded = layouts['length_grouped' if args.group_by_length else 'plain']
+        report['hours_per_epoch'] = padded / args.dry_run_tokens_per_second / 3600
+
+    print(f"Train rows: {report['loaded_rows']} loaded, {report['truncated_rows']} truncated to {args.model_max_len} tokens, "
+          f"{report['skipped_excess_length_rows']} dropped by skip_excess_length, {len(lengths)} left.")
+    split = f" ({report['prompt_tokens']} prompt, {report['response_tokens']} response)" if 'prompt_tokens' in report else ''
+    print(f"Tokens: {tokens}{split}, "
+          + ', '.join(f'{k}={v}' for k, v in report['length_percentiles'].items()))
+    width = max(counts.max(), 1)
+    for bucket in report['length_histogram']:
+        print(f"  {bucket['from']:>6}-{bucket['to']:<6} {bucket['rows']:>8} {'#' * round(40 * bucket['rows'] / width)}")
+    for layout, padding in report['padding'].items():
+        print(f"Padding waste, {layout}: {padding['waste']:.1%} of {padding['tokens']} tokens")
+    print(f"Optimizer steps: {steps_per_epoch} per epoch, {report['total_steps']} total "
+          f"(batch size {batch_size}, accumulation {args.gradient_accumulation_steps}, world size {world_size})")
+    if 'hours_per_epoch' in report:
+        print(f"Projected time: {report['hours_per_epoch']:.2f} hours per epoch")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(join(args.output_dir, 'data_report.json'), 'w') as fout:
+        json.dump(report, fout, indent=2)
+    return report
+
 def _is_bos_present_in_template(tokenizer, sample_conversation: List[Dict]):
     sample = tokenizer.apply_chat_template(sample_conversation, tokenize=False, add_generation_prompt=True)
     bos_token_present = sample.startswith(tokenizer.bos_token)
     return bos_token_present
 
 
-def _apply_and_tokenize_batches(tokenizer, max_len, items, add_special, train_on_source=True):
+def _apply_and_tokenize_batches(tokenizer, max_len, items, add_special, train_on_source=True, cache=None):
     if type(items) != LazyBatch:
         raise ValueError("_apply_and_tokenize_batches should be used with batched map method! e.g. dataset.map(lambda x: _apply_and_tokenize_batches(tokenizer, x, True, True), batched=True)")
 
+    conversations = items[CONVERSATION_KEY]
+    if cache is None:
+        return _apply_and_tokenize(tokenizer, max_len, conversations, add_special, train_on_source)
+
+    # Only render and tokenize conversations that are not in the cache yet.
+    keys = [cache.key(conversation) for conversation in conversations]
+    cached = cache.get_many(keys)
+    missing = [idx for idx, key in enumerate(keys) if key not in cached]
+    if missing:
+        columns = _apply_and_tokenize(tokenizer, max_len, [conversations[idx] for idx in missing], add_special, train_on_source)
+        prompt_lens = columns.get(DS_PROMPT_LEN_KEY, [None] * len(missing))
+        entries = [(keys[idx], full, prompt_len) for idx, full, prompt_len in zip(missing, columns[DS_FULL_KEY], prompt_lens)]
+        cache.put_many(entries)
+        cached.update({key: (full, prompt_len) for key, full, prompt_len in entries})
+    cache.hits += len(keys) - len(missing)
+    cache.misses += len(missing)
+
+    columns = {
+        DS_FULL_KEY: [cached[key][0] for key in keys]
+    }
+    if not train_on_source:
+        columns[DS_PROMPT_LEN_KEY] = [cached[key][1] for key in keys]
+    return columns
+
+def _apply_and_tokenize(tokenizer, max_len, conversations, add_special, train_on_source=True):
     bos = tokenizer.bos_token if add_special else ''
     eos = tokenizer.eos_token if add_special else ''
 
     str_list = []
-    for item in items[CONVERSATION_KEY]:
+    for item in conversations:
         str_list.append(bos + tokenizer.apply_chat_template(item, tokenize=False, add_generation_prompt=False) + eos)
 
     full_input_ids_list = tokenize(tokenizer, max_len, str_list).input_ids
@@ -627,7 +1154,7 @@ def _apply_and_tokenize_batches(tokenizer, max_len, items, add_special, train_on
 
     if not train_on_source:
         str_src_list = []
-        for item in items[CONVERSATION_KEY]:
+        for item in conversations:
             str_src_list.append(
                 bos + tokenizer.apply_chat_template(item[:-1], tokenize=False, add_generation_prompt=True))
 
@@ -637,6 +1164,76 @@ def _apply_and_tokenize_batches(tokenizer, max_len, items, add_special, train_on
 
     return columns
 
+def _tokenizer_fingerprint(tokenizer, *extra):
+    """
+    Hash of everything that affects how a conversation is rendered and tokenized.
+    """
+    if tokenizer.is_fast:
+        # Drop truncation/padding, they reflect the last call made with the tokenizer.
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        state.pop('truncation', None)
+        state.pop('padding', None)
+        vocab = json.dumps(state, sort_keys=True)
+    else:
+        vocab = json.dumps(sorted(tokenizer.get_vocab().items()))
+    hasher = hashlib.sha256()
+    for part in (type(tokenizer).__name__, vocab, tokenizer.chat_template, json.dumps(tokenizer.special_tokens_map, sort_keys=True), *extra):
+        hasher.update(str(part).encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:16]
+
+class TokenizationCache(object):
+    """
+    Content addressed store of tokenized conversations, one sqlite database per tokenizer/template/length
+    fingerprint. Rows are keyed by a hash of the conversation, so when a dataset grows or is edited only the
+    new and changed rows are rendered and tokenized again.
+    """
+    def __init__(self, cache_dir, fingerprint):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = join(cache_dir, f'tokenized-{fingerprint}.sqlite')
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+
+    def __getstate__(self):
+        # datasets pickles map functions (for hashing and workers), sqlite connections can not be pickled.
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS rows (key BLOB PRIMARY KEY, full BLOB NOT NULL, prompt_len INTEGER)')
+        return self._connection
+
+    @staticmethod
+    def key(conversation):
+        return hashlib.sha256(json.dumps(conversation, sort_keys=True, ensure_ascii=False).encode('utf-8')).digest()
+
+    def get_many(self, keys):
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT key, full, prompt_len FROM rows WHERE key IN ({",".join("?" * len(chunk))})', chunk
+            )
+            for key, full, prompt_len in rows:
+                found[key] = (np.frombuffer(full, dtype=np.int32).tolist(), prompt_len)
+        return found
+
+    def put_many(self, entries):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO rows VALUES (?, ?, ?)',
+                [(key, np.asarray(full, dtype=np.int32).tobytes(), prompt_len) for key, full, prompt_len in entries]
+            )
+
 def tokenize(tokenizer, model_max_len, sequence):
     return tokenizer(
         sequence,
@@ -646,6 +1243,96 @@ def tokenize(tokenizer, model_max_len, sequence):
         padding=False
     )
 
+def _tokenize_mmlu_batches(tokenizer, source_max_len, items):
+    # Question and answer are tokenized separately, so the answer letter is always a token of its own.
+    sources = tokenize(tokenizer, source_max_len, [f"{tokenizer.bos_token}{source}" for source in items['input']]).input_ids
+    targets = tokenize(tokenizer, source_max_len, [f"{target}{tokenizer.eos_token}" for target in items['output']]).input_ids
+    return {
+        DS_FULL_KEY: [source + target for source, target in zip(sources, targets)],
+        DS_PROMPT_LEN_KEY: [len(source) for source in sources],
+    }
+
+def get_mmlu_shard(num_examples, process_index, num_processes):
+    """
+    Returns the contiguous slice of MMLU example indices scored by one process. All shards have the
+    same length so results can be gathered, short shards repeat the last index.
+    """
+    shard_size = -(-num_examples // num_processes)
+    shard = list(range(process_index * shard_size, min(num_examples, (process_index + 1) * shard_size)))
+    return shard + [num_examples - 1] * (shard_size - len(shard))
+
+def score_mmlu_logits(logits, labels, abcd):
+    """
+    Returns the predicted and reference answer (index into `abcd`) and the mean label loss of every
+    row. Labels are ignored up to the answer token, which is followed by the eos token.
+    """
+    logits = logits[:, :-1]
+    labels = labels[:, 1:]
+    mask = labels.ne(IGNORE_INDEX)
+    rows, cols = mask.nonzero(as_tuple=True)
+    token_losses = torch.nn.functional.cross_entropy(logits[rows, cols].float(), labels[rows, cols], reduction='none')
+    losses = torch.zeros(len(labels), device=labels.device).index_add_(0, rows, token_losses) / mask.sum(-1)
+    answer_pos = mask.int().argmax(-1)
+    row_idx = torch.arange(len(labels), device=labels.device)
+    preds = logits[row_idx, answer_pos][:, abcd].argmax(-1)
+    refs = (labels[row_idx, answer_pos][:, None] == abcd).int().argmax(-1)
+    return preds, refs, losses
+
+def _common_prefix_len(sequences):
+    first = sequences[0]
+    prefix_len = min(len(sequence) for sequence in sequences)
+    for sequence in sequences[1:]:
+        prefix_len = next((pos for pos in range(prefix_len) if sequence[pos] != first[pos]), prefix_len)
+    return prefix_len
+
+def score_mmlu_with_prefix_cache(model, examples, abcd, batch_size, pad_token_id):
+    """
+    Scores MMLU examples that share a few-shot prefix, like score_mmlu_logits. The longest common token
+    prefix of the questions is run once and its KV cache is reused, so only the question suffixes and
+    answers go through the model.
+    """
+    device = abcd.device
+    prompts = [example[DS_FULL_KEY][:example[DS_PROMPT_LEN_KEY]] for example in examples]
+    # Keep at least one question token per example, its logits predict the answer.
+    prefix_len = min(_common_prefix_len(prompts), min(len(prompt) for prompt in prompts) - 1)
+    past_key_values = None
+    if prefix_len > 0:
+        prefix = torch.tensor([prompts[0][:prefix_len]], device=device)
+        past_key_values = model(input_ids=prefix, use_cache=True).past_key_values
+        if hasattr(past_key_values, 'to_legacy_cache'):
+            past_key_values = past_key_values.to_legacy_cache()
+
+    preds, refs, losses = [], [], []
+    for start in range(0, len(examples), batch_size):
+        batch = examples[start:start + batch_size]
+        suffixes = [torch.tensor(example[DS_FULL_KEY][prefix_len:]) for example in batch]
+        labels = [
+            torch.tensor([IGNORE_INDEX] * (example[DS_PROMPT_LEN_KEY] - prefix_len) + example[DS_FULL_KEY][example[DS_PROMPT_LEN_KEY]:])
+            for example in batch
+        ]
+        input_ids = pad_sequence(suffixes, batch_first=True, padding_value=pad_token_id).to(device)
+        labels = pad_sequence(labels, batch_first=True, padding_value=IGNORE_INDEX).to(device)
+        lengths = torch.tensor([len(suffix) for suffix in suffixes], device=device)
+        suffix_mask = (torch.arange(input_ids.shape[1], device=device)[None, :] < lengths[:, None]).long()
+        attention_mask = torch.cat([suffix_mask.new_ones(len(batch), prefix_len), suffix_mask], dim=1)
+        position_ids = torch.arange(prefix_len, prefix_len + input_ids.shape[1], device=device).expand(len(batch), -1)
+        batch_past_key_values = None
+        if past_key_values is not None:
+            batch_past_key_values = tuple(
+                tuple(tensor.expand(len(batch), *tensor.shape[1:]) for tensor in layer) for layer in past_key_values
+            )
+        logits = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=batch_past_key_values,
+        ).logits
+        batch_preds, batch_refs, batch_losses = score_mmlu_logits(logits, labels, abcd)
+        preds.append(batch_preds)
+        refs.append(batch_refs)
+        losses.append(batch_losses)
+    return torch.cat(preds), torch.cat(refs), torch.cat(losses)
+
 def get_last_checkpoint(checkpoint_dir):
     if isdir(checkpoint_dir):
         is_completed = exists(join(checkpoint_dir, 'completed'))
@@ -672,10 +1359,20 @@ def train():
     )
     print(args)
 
+    if args.dry_run_data:
+        set_seed(args.seed)
+        data_module = make_data_module(tokenizer=get_tokenizer(args), args=args)
+        report_data_statistics(data_module, args)
+        return
+
     checkpoint_dir, completed_training = get_last_checkpoint(args.output_dir)
     if completed_training:
         print('Detected that training was already completed!')
 
+    args.adapter_configs = load_adapter_configs(args)
+    if args.do_mmlu_eval and args.mmlu_prefix_caching and (is_deepspeed_zero3_enabled() or args.using_fsdp):
+        # Ranks run a different number of forwards per subject, which deadlocks sharded parameter gathers.
+        raise ValueError("mmlu_prefix_caching is not supported with DeepSpeed ZeRO-3 or FSDP.")
     model, tokenizer = get_accelerate_model(args, checkpoint_dir)
 
     model.config.use_cache = False
@@ -685,11 +1382,15 @@ def train():
     data_module = make_data_module(tokenizer=tokenizer, args=args)
 
     training_args.neftune_noise_alpha = args.neftune_noise_alpha
-    trainer = Seq2SeqTrainer(
+    trainer_cls, trainer_kwargs = (Seq2SeqTrainer if args.full_finetune else PeftTrainer), {}
+    if args.multi_adapter_config:
+        trainer_cls, trainer_kwargs = MultiAdapterTrainer, {'adapter_configs': args.adapter_configs}
+    trainer = trainer_cls(
         model=model,
         tokenizer=tokenizer,
         args=training_args,
-        **{k:v for k,v in data_module.items() if k != 'predict_dataset'},
+        **{k:v for k,v in data_module.items() if k not in ('predict_dataset', 'data_stats')},
+        **trainer_kwargs,
     )
 
     # Callbacks
@@ -701,17 +1402,25 @@ def train():
                 'eval': 'data/mmlu/zero_shot_mmlu_val.json',
                 'test': 'data/mmlu/zero_shot_mmlu_test.json',
             })
-            mmlu_dataset = mmlu_dataset.remove_columns('subject')
         # MMLU Five-shot (Eval/Test only)
         elif args.mmlu_dataset == 'mmlu' or args.mmlu_dataset == 'mmlu-fs':
             mmlu_dataset = load_dataset("json", data_files={
                 'eval': 'data/mmlu/five_shot_mmlu_val.json',
                 'test': 'data/mmlu/five_shot_mmlu_test.json',
             })
-            # mmlu_dataset = mmlu_dataset.remove_columns('subject')
         mmlu_dataset = mmlu_dataset[args.mmlu_split]
         if args.max_mmlu_samples is not None:
             mmlu_dataset = mmlu_dataset.select(range(args.max_mmlu_samples))
+        mmlu_dataset = mmlu_dataset.map(
+            lambda x: _tokenize_mmlu_batches(tokenizer, args.mmlu_source_max_len, x), batched=True, desc="Tokenize MMLU"
+        )
+        mmlu_subjects = mmlu_dataset['subject']
+        mmlu_collator = DataCollatorForCausalLM(
+            tokenizer=tokenizer,
+            model_max_len=args.mmlu_source_max_len,
+            train_on_source=False,
+            predict_with_generate=False,
+        )
         abcd_idx = [
             tokenizer("A", add_special_tokens=False).input_ids[0],
             tokenizer("B", add_special_tokens=False).input_ids[0],
@@ -722,29 +1431,59 @@ def train():
 
         class MMLUEvalCallback(transformers.TrainerCallback):
             def on_evaluate(self, args, state, control, model, **kwargs):
-                data_loader = trainer.get_eval_dataloader(mmlu_dataset)
-                model_max_len = trainer.data_collator.model_max_len
-                trainer.data_collator.model_max_len = args.mmlu_source_max_len
+                # Every rank scores an equally sized slice of MMLU, results are gathered and scored once.
+                accelerator = trainer.accelerator
+                shard = get_mmlu_shard(len(mmlu_dataset), accelerator.process_index, accelerator.num_processes)
+                abcd = torch.tensor(abcd_idx, device=args.device)
                 trainer.model.eval()
-                preds, refs = [], []
-                loss_mmlu = 0
-                for batch in tqdm(data_loader, total=len(data_loader)):
-                    (loss, logits, labels) = trainer.prediction_step(trainer.model,batch,prediction_loss_only=False,)
-                    # There are two tokens, the output, and eos token.
-                    for i, logit in enumerate(logits):
-                        label_non_zero_id = (batch['labels'][i] != -100).nonzero()[0][0]
-                        logit_abcd = logit[label_non_zero_id-1][abcd_idx]
-                        preds.append(torch.argmax(logit_abcd).item())
-                    labels = labels[labels != IGNORE_INDEX].view(-1, 2)[:,0]
-                    refs += [abcd_idx.index(label) for label in labels.tolist()]
-                    loss_mmlu += loss.item()
+                preds, refs, losses = [], [], []
+                with torch.no_grad(), trainer.compute_loss_context_manager():
+                    if args.mmlu_prefix_caching:
+                        # Few-shot examples are shared within a subject, so the prefix is cached per subject.
+                        shard = sorted(shard, key=lambda idx: mmlu_subjects[idx])
+                        groups = [list(group) for _, group in itertools.groupby(shard, key=lambda idx: mmlu_subjects[idx])]
+                        for group in tqdm(groups, disable=not accelerator.is_local_main_process):
+                            group_preds, group_refs, group_losses = score_mmlu_with_prefix_cache(
+                                trainer.model,
+                                [mmlu_dataset[idx] for idx in group],
+                                abcd,
+                                batch_size=args.per_device_eval_batch_size,
+                                pad_token_id=tokenizer.pad_token_id,
+                            )
+                            preds.append(group_preds)
+                            refs.append(group_refs)
+                            losses.append(group_losses)
+                    else:
+                        data_loader = torch.utils.data.DataLoader(
+                            mmlu_dataset.select(shard),
+                            batch_size=args.per_device_eval_batch_size,
+                            collate_fn=mmlu_collator,
+                        )
+                        for batch in tqdm(data_loader, total=len(data_loader), disable=not accelerator.is_local_main_process):
+                            batch = trainer._prepare_inputs(batch)
+                            logits = trainer.model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask']).logits
+                            batch_preds, batch_refs, batch_losses = score_mmlu_logits(logits, batch['labels'], abcd)
+                            preds.append(batch_preds)
+                            refs.append(batch_refs)
+                            losses.append(batch_losses)
+                gathered = accelerator.gather({
+                    'index': torch.tensor(shard, device=args.device),
+                    'pred': torch.cat(preds),
+                    'ref': torch.cat(refs),
+                    'loss': torch.cat(losses),
+                })
+                if not accelerator.is_main_process:
+                    return
+                # Padded shards repeat the last example, keep a single result per example.
+                scored = {}
+                for idx, pred, ref, loss in zip(*(gathered[key].tolist() for key in ('index', 'pred', 'ref', 'loss'))):
+                    scored.setdefault(idx, (pred, ref, loss))
                 # Extract results by subject.
-                results = {'mmlu_loss':loss_mmlu/len(data_loader)}
-                subject = mmlu_dataset['subject']
-                subjects = {s:{'refs':[], 'preds':[]} for s in set(subject)}
-                for s,p,r in zip(subject, preds, refs):
-                    subjects[s]['preds'].append(p)
-                    subjects[s]['refs'].append(r)
+                results = {'mmlu_loss': np.mean([loss for _, _, loss in scored.values()])}
+                subjects = {s:{'refs':[], 'preds':[]} for s in set(mmlu_subjects)}
+                for idx, (pred, ref, _) in scored.items():
+                    subjects[mmlu_subjects[idx]]['preds'].append(pred)
+                    subjects[mmlu_subjects[idx]]['refs'].append(ref)
                 subject_scores = []
                 for subject in subjects:
                     subject_score = accuracy.compute(
@@ -754,8 +1493,11 @@ def train():
                     results[f'mmlu_{args.mmlu_split}_accuracy_{subject}'] = subject_score
                     subject_scores.append(subject_score)
                 results[f'mmlu_{args.mmlu_split}_accuracy'] = np.mean(subject_scores)
+                if args.multi_adapter_config:
+                    # MultiAdapterTrainer evaluates once per adapter, so scores are keyed like `loss_<name>`.
+                    adapter_name = accelerator.unwrap_model(model).active_adapter
+                    results = {f'{key}_{adapter_name}': value for key, value in results.items()}
                 trainer.log(results)
-                trainer.data_collator.model_max_len = model_max_len
 
         trainer.add_callback(MMLUEvalCallback)
 
@@ -827,17 +1569,19 @@ def train():
                 args_dict.pop('generation_config')
                 args_dict.pop('distributed_state')
                 args_dict.pop('__cached__setup_devices')
-                json.dump(args_dict, f, indent=4)
+                json.dump(args_dict, f, indent=4, default=str)
 
         # add specify dataset name add eval loss.
-        trainer.push_to_hub(commit_message="Model card update.", dataset=args.dataset)
+        if args.push_to_hub:
+            trainer.push_to_hub(commit_message="Model card update.", dataset=args.dataset)
 
 
     # Safely save final full-tune model.
     if args.full_finetune:
         trainer.accelerator.wait_for_everyone()
-        state_dict = trainer.accelerator.get_state_dict(trainer.deepspeed)
-        unwrapped_model = trainer.accelerator.unwrap_model(trainer.deepspeed)
+        wrapped_model = trainer.deepspeed if args.deepspeed else trainer.model
+        state_dict = trainer.accelerator.get_state_dict(wrapped_model)
+        unwrapped_model = trainer.accelerator.unwrap_model(wrapped_model)
         if trainer.accelerator.is_main_process:
             unwrapped_model.save_pretrained(args.final_output_dir, state_dict=state_dict, max_shard_size=args.max_shard_size)
             with open(os.path.join(args.final_output_dir, "config.json")) as infile:
@@ -850,7 +1594,7 @@ def train():
     else:
         if args.deepspeed:
             trainer.accelerator.wait_for_everyone()
-            state_dict = trainer.accelerator.get_state_dict(trainer.deepspeed)
+            state_dict = get_trainable_state_dict(trainer.accelerator, trainer.deepspeed)
             unwrapped_model = trainer.accelerator.unwrap_model(trainer.deepspeed)
             if trainer.accelerator.is_main_process:
                 unwrapped_model.save_pretrained(args.final_output_dir, safe_serialization=True, state_dict=state_dict)